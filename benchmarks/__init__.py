@@ -0,0 +1,4 @@
+"""
+This package contains micro-benchmarks for performance-critical parts of
+Svetlana. Run a benchmark with, e.g., `python -m benchmarks.parse`.
+"""
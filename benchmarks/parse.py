@@ -0,0 +1,76 @@
+"""
+This module compares the game page parser with the original implementation,
+which matched every pattern against every line of the page.
+"""
+
+import argparse
+import glob
+import os
+import re
+import timeit
+
+from collections import defaultdict
+
+from svetlana.webdiplomacy import WebDiplomacyClient
+
+FIXTURES = os.path.join(os.path.dirname(__file__), '..', 'tests', 'fixtures')
+
+
+def legacy_parse(content):
+    """The original parser, which is kept as a reference implementation."""
+    patterns = {
+        'name':      r'.*gameName">(.*?)<.*',
+        'date':      r'.*gameDate">(.*?)<.*',
+        'phase':     r'.*gamePhase">(.*?)<.*',
+        'defeated':  r'.*memberCountryName.*memberStatusDefeated">(.*?)<.*',
+        'drawn':     r'.*memberCountryName.*memberStatusDrawn">(.*?)<.*',
+        'ready':     r'.*memberCountryName.*tick.*rStatusPlaying">(.*?)<.*',
+        'not_ready': r'.*memberCountryName.*alert.*StatusPlaying">(.*?)<.*',
+        'won':       r'.*memberCountryName.*memberStatusWon">(.*?)<.*',
+        'deadline':  r'.*gameTimeRemaining.*unixtime="([0-9]+)".*',
+        'pregame':   r'.*(memberPreGameList)">.*',
+        'map_link':  r'.*<a.*LargeMapLink.*href="(.*?)".*',
+    }
+    data = defaultdict(list)
+
+    for line in content.split('\n'):
+        for key, pattern in patterns.items():
+            match = re.match(pattern, line.strip())
+            if match:
+                data[key] += [match.group(1)]
+
+    return data
+
+
+def bench(path, number):
+    """Times both parsers on a page and returns the timings in seconds."""
+    with open(path) as page:
+        content = page.read()
+
+    # pylint: disable=protected-access
+    assert WebDiplomacyClient._parse(content) == legacy_parse(content)
+    legacy = timeit.timeit(lambda: legacy_parse(content), number=number)
+    current = timeit.timeit(lambda: WebDiplomacyClient._parse(content),
+            number=number)
+    return legacy/number, current/number
+
+
+def main():
+    """Runs the benchmark on all page fixtures."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--number', type=int, default=20,
+            help='Number of runs per page')
+    parser.add_argument('pages', nargs='*',
+            default=sorted(glob.glob(os.path.join(FIXTURES, 'board_*.html'))),
+            help='Game pages to parse')
+    args = parser.parse_args()
+
+    print(f'{"page":<24} {"legacy (ms)":>12} {"current (ms)":>12} {"speedup":>8}')
+    for path in args.pages:
+        legacy, current = bench(path, args.number)
+        print(f'{os.path.basename(path):<24} {legacy*1000:>12.2f} '
+              f'{current*1000:>12.2f} {legacy/current:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,15 +3,18 @@ This module contains a Discord client which acts as a WebDiplomacy notification
 bot.
 """
 
+import bisect
 import logging
 import asyncio
 
-from time import sleep
+from time import time
 
 import discord
 
 from svetlana.bot import actions
-from svetlana.db import Pollers, Alarms
+from svetlana.bot.delivery import MapDeliveryQueue
+from svetlana.bot.scheduler import PollScheduler
+from svetlana.db import Database, Pollers, Alarms
 from svetlana.webdiplomacy import InvalidGameError
 
 
@@ -19,13 +22,16 @@ class DiscordClient(discord.Client):
     """A Discord client which is used to poll WebDiplomacy games."""
     def __init__(self, wd_client, db_file='svetlana.db', polling=True):
         self.wd_client = wd_client
-        self.pollers = Pollers(db_file)
-        self.alarms = Alarms(db_file)
+        self.database = Database(db_file)
+        self.pollers = Pollers(self.database)
+        self.alarms = Alarms(self.database)
+        self.scheduler = PollScheduler()
+        self.map_delivery = MapDeliveryQueue(wd_client, self._send)
         if polling:
             asyncio.Task(self._start_poll())
         super().__init__()
 
-    def follow(self, game_id, channel_id):
+    async def follow(self, game_id, channel_id):
         """Start following a given game by adding it to a list."""
         if not channel_id:
             return False
@@ -34,11 +40,12 @@ class DiscordClient(discord.Client):
         if obj in self.pollers:
             return False
 
-        self.pollers.append(obj)
-        logging.info('Following: %s', self.pollers)
+        await self.pollers.append_async(obj)
+        self.scheduler.discard(game_id)
+        logging.info('Following %s in channel %s', game_id, channel_id)
         return True
 
-    def unfollow(self, game_id, channel_id):
+    async def unfollow(self, game_id, channel_id):
         """Stop following a given game by removing it to a list."""
         if not channel_id:
             return False
@@ -47,11 +54,11 @@ class DiscordClient(discord.Client):
         if obj not in self.pollers:
             return False
 
-        self.pollers.remove(obj)
-        logging.info('Following: %s', self.pollers)
+        await self.pollers.remove_async(obj)
+        logging.info('Unfollowing %s in channel %s', game_id, channel_id)
         return True
 
-    def add_alert(self, hours, channel_id):
+    async def add_alert(self, hours, channel_id):
         """Add an alert for X hours before a deadline."""
         if not channel_id:
             return False
@@ -60,11 +67,12 @@ class DiscordClient(discord.Client):
         if obj in self.alarms:
             return False
 
-        self.alarms.append(obj)
-        logging.info('Alerting at: %s', self.alarms)
+        await self.alarms.append_async(obj)
+        self._reschedule_channel(channel_id)
+        logging.info('Alerting at T-%sh in channel %s', hours, channel_id)
         return True
 
-    def remove_alert(self, hours, channel_id):
+    async def remove_alert(self, hours, channel_id):
         """Stop alerting X hours before a deadline."""
         if not channel_id:
             return False
@@ -73,65 +81,150 @@ class DiscordClient(discord.Client):
         if obj not in self.alarms:
             return False
 
-        self.alarms.remove(obj)
-        logging.info('Alerting at: %s', self.alarms)
+        await self.alarms.remove_async(obj)
+        logging.info('Silencing T-%sh in channel %s', hours, channel_id)
         return True
 
-    async def _start_poll(self, period=30):
-        """Keep polling a list of games every X minutes.
+    def _reschedule_channel(self, channel_id):
+        """Poll the games of a channel soon, e.g. after its alarms changed."""
+        for game_id in self.pollers.channel_games(channel_id):
+            self.scheduler.discard(game_id)
+
+    async def _start_poll(self, period=10):
+        """Keep polling the games which are due every X seconds.
 
         Note that it first waits, then polls to prevent issues with fetching a
         channel before the client is actually logged in.
         """
         while True:
             await asyncio.sleep(period)
-            for game_id, channel_id, last_delta in self.pollers:
-                try:
-                    game = self.wd_client.fetch(game_id)
-                    result = self._poll(game, channel_id, last_delta)
-                    if result:
-                        channel = self.get_channel(channel_id)
-                        embed = self.get_embed(game, result)
-
-                        await channel.send(embed=embed)
-                except InvalidGameError:
-                    self.unfollow(game_id, channel_id)
-                    channel = self.get_channel(channel_id)
-                    await channel.send(
-                            'The game seems to be cancelled! Unfollowing..')
-
-
-    def _poll(self, game, channel_id, last_delta, map_generate_seconds=10):
-        """Poll a game. Returns a message, if needed."""
+            await self._poll_cycle()
+
+    async def _poll_cycle(self):
+        """Fetch all due games concurrently and notify their channels.
+
+        Every game is fetched only once per cycle, regardless of the number of
+        channels following it. Games which have not been scheduled by
+        `self.scheduler` yet are always due.
+        """
+        due = set(self.scheduler.pop_due())
+        subscriptions = {
+                game_id: self.pollers.channels(game_id)
+                for game_id in self.pollers.games()
+                if game_id in due or game_id not in self.scheduler}
+
+        game_ids = list(subscriptions)
+        games = await self.wd_client.fetch_all(game_ids)
+
+        sends = []
+        async with self.pollers.batch_async():
+            for game_id, game in zip(game_ids, games):
+                if isinstance(game, Exception) and \
+                        not isinstance(game, InvalidGameError):
+                    logging.error('Could not fetch game %s: %r', game_id, game)
+                    self.scheduler.schedule(game_id,
+                            time() + self.scheduler.min_interval)
+                    continue
+                alarm_messages = {}
+                deferred = []
+                for channel_id, last_delta in subscriptions[game_id].items():
+                    if isinstance(game, InvalidGameError):
+                        await self.unfollow(game_id, channel_id)
+                        sends.append(self._send(channel_id,
+                            'The game seems to be cancelled! Unfollowing..'))
+                        continue
+
+                    result = self._poll(game, channel_id, last_delta,
+                            alarm_messages=alarm_messages)
+                    if not game.pregame and (game.won or game.drawn):
+                        await self.unfollow(game_id, channel_id)
+                    if result and self._new_round(game, last_delta):
+                        deferred.append((channel_id,
+                            {'embed': self.get_embed(game, result)}))
+                    elif result:
+                        sends.append(self._send(channel_id,
+                            embed=self.get_embed(game, result)))
+
+                if deferred:
+                    self.map_delivery.defer(game, deferred)
+
+                if not isinstance(game, Exception):
+                    self.scheduler.reschedule(game, set().union(
+                        *(self.alarms.thresholds(channel_id)
+                          for channel_id in subscriptions[game_id])))
+
+        await asyncio.gather(*sends)
+
+    async def close(self):
+        """Write pending database updates, then log out and close."""
+        await self.pollers.flush_async()
+        self.map_delivery.cancel()
+        await super().close()
+
+    async def _send(self, channel_id, *args, **kwargs):
+        """Send a message to a channel, logging (not raising) failures."""
+        channel = self.get_channel(channel_id)
+        try:
+            await channel.send(*args, **kwargs)
+        except (AttributeError, discord.DiscordException) as exc:
+            logging.error('Could not send to channel %s: %r', channel_id, exc)
+
+    def _crossed_alarm(self, channel_id, last_delta, delta):
+        """Returns the smallest alarm threshold (in hours) of a channel which
+        was crossed between two polls, or None if no threshold was crossed.
+        """
+        if not last_delta or delta is None:
+            return None
+
+        thresholds = self.alarms.thresholds(channel_id)
+        first = bisect.bisect_left(thresholds, delta/3600)
+        if first < len(thresholds) and thresholds[first]*3600 < last_delta:
+            return thresholds[first]
+        return None
+
+    @staticmethod
+    def _alarm_message(game, hours):
+        """Returns the message for an alarm threshold which was crossed."""
+        if game.not_ready:
+            countries = ', '.join(game.not_ready)
+            return f"{hours}h left! These countries aren't ready: " + countries
+        return f"{hours}h left, everybody's ready!"
+
+    @staticmethod
+    def _new_round(game, last_delta):
+        """Returns whether a new round started since the last poll."""
+        return bool(not game.pregame and not game.won and not game.drawn and
+                    last_delta and game.delta > last_delta)
+
+    def _poll(self, game, channel_id, last_delta, alarm_messages=None):
+        """Poll a game. Returns a message, if needed.
+
+        Note that finished games are not unfollowed here and that the message
+        of a new round should only be sent once its map is ready (see
+        `MapDeliveryQueue`); both are up to the caller.
+
+        Alarm messages are stored in `alarm_messages` (by hours), so channels
+        which follow the same game can share them.
+        """
         msg = None
         if game.pregame:
             if game.hours_left % 24 == 0 and game.minutes_left == 0:
                 msg = f'The game starts in {game.days_left} days!'
         elif game.won:
-            self.unfollow(game.game_id, channel_id)
             msg = f'{game.won} has won!'
         elif game.drawn:
             countries = ', '.join(game.drawn)
-            self.unfollow(game.game_id, channel_id)
             msg = f'The game was a draw between {countries}!'
-        elif last_delta and game.delta > last_delta:
-            # NOTE(jhartog): We need to give WebDiplomacy some time to generate
-            # a map, otherwise we'll get the map from last turn.
-            sleep(map_generate_seconds)
+        elif self._new_round(game, last_delta):
             msg = 'Starting new round! Good luck :)'
 
-        for hours, ch_id in self.alarms:
-            if ch_id != channel_id:
-                continue
-
-            if last_delta and game.delta <= hours*3600 and \
-                    last_delta > hours*3600:
-                if game.not_ready:
-                    countries = ', '.join(game.not_ready)
-                    msg = f"{hours}h left! These countries aren't ready: " + \
-                            countries
-                else:
-                    msg = f"{hours}h left, everybody's ready!"
+        hours = self._crossed_alarm(channel_id, last_delta, game.delta)
+        if hours is not None:
+            if alarm_messages is None:
+                alarm_messages = {}
+            if hours not in alarm_messages:
+                alarm_messages[hours] = self._alarm_message(game, hours)
+            msg = alarm_messages[hours]
 
         self.pollers.update_delta((game.game_id, channel_id), game.delta)
         return msg
@@ -148,7 +241,7 @@ class DiscordClient(discord.Client):
 
         return embed
 
-    def _answer_message(self, message):
+    async def _answer_message(self, message):
         """React to a message."""
         words = message.content.split(' ')
         command = words[1]
@@ -162,7 +255,7 @@ class DiscordClient(discord.Client):
 
         try:
             resp_gen = getattr(actions, f'respond_{command}')
-            response = resp_gen(
+            response = await resp_gen(
                 bot=self,
                 message=message,
                 command=command,
@@ -180,7 +273,7 @@ class DiscordClient(discord.Client):
         words = message.content.split(' ')
         if words[0].lower() in {'svetlana', 'svet'}:
             try:
-                answer = self._answer_message(message)
+                answer = await self._answer_message(message)
                 if not answer:
                     raise ValueError(f'Unknown command: {message.content}')
                 if isinstance(answer, discord.Embed):
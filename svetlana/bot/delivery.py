@@ -0,0 +1,73 @@
+"""
+This module contains a queue which delays notifications about a new round
+until WebDiplomacy has generated the map of that round.
+"""
+
+import asyncio
+import logging
+
+
+class MapDeliveryQueue:
+    """Delivers messages once the map of a game has been regenerated.
+
+    After a new round starts, WebDiplomacy needs some time to generate the new
+    map. Instead of waiting a fixed amount of time, the map is downloaded every
+    `interval` seconds until it differs from the map of the previous delivery
+    for that game. When the map cannot be confirmed within `max_wait`
+    seconds, the messages are delivered anyway.
+
+    Every game is checked by one background task, regardless of the number of
+    channels which are notified.
+    """
+    def __init__(self, wd_client, send, interval=5, max_wait=60):
+        self.wd_client = wd_client
+        self.send = send
+        self.interval = interval
+        self.max_wait = max_wait
+        self._digests = {}
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def defer(self, game, messages):
+        """Queue (channel ID, kwargs) pairs to be sent once the map of a game
+        is ready."""
+        task = asyncio.ensure_future(self._deliver(game, list(messages)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _map_ready(self, game):
+        """Returns the digest of the map of a game if it is new, else None."""
+        try:
+            digest = await self.wd_client.fetch_map_digest(game.map_url)
+        except Exception as exc: # pylint: disable=broad-except
+            logging.warning('Could not fetch map of %s: %r', game.game_id, exc)
+            return None
+        if digest and digest != self._digests.get(game.game_id):
+            return digest
+        return None
+
+    async def _deliver(self, game, messages):
+        """Wait for the new map of a game, then send the messages."""
+        loop = asyncio.get_running_loop()
+        give_up = loop.time() + self.max_wait
+        while True:
+            await asyncio.sleep(self.interval)
+            digest = await self._map_ready(game)
+            if digest:
+                self._digests[game.game_id] = digest
+                break
+            if loop.time() >= give_up:
+                logging.warning('No new map for %s, sending anyway',
+                        game.game_id)
+                break
+
+        await asyncio.gather(*(self.send(channel_id, **kwargs)
+                               for channel_id, kwargs in messages))
+
+    def cancel(self):
+        """Cancel all pending deliveries."""
+        for task in list(self._tasks):
+            task.cancel()
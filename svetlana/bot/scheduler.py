@@ -0,0 +1,90 @@
+"""
+This module contains a scheduler which decides when each followed game should
+be polled next, based on the instants at which something interesting happens.
+"""
+
+import heapq
+import time
+
+MINUTE = 60
+HOUR = 60*MINUTE
+DAY = 24*HOUR
+
+
+class PollScheduler:
+    """A priority queue of games, keyed on the time they should be polled.
+
+    A game is polled just after each instant at which an alarm threshold is
+    crossed or the deadline passes, and just before each day boundary of a
+    pregame game (when the number of days until the start is announced).
+    Around the deadline, or when every player is ready, games are polled every
+    `min_interval` seconds; otherwise at least every `max_interval` seconds.
+    Games which have not been scheduled yet are due immediately.
+    """
+    # Seconds after an alarm threshold or deadline to poll at.
+    GRACE = 5
+    # Seconds before a pregame day boundary to poll at; the announcement is
+    # made during the last minute before the boundary.
+    PREGAME_LEAD = 45
+    # Seconds after the deadline during which games are polled densely.
+    DEADLINE_WINDOW = 10*MINUTE
+
+    def __init__(self, min_interval=30, max_interval=5*MINUTE):
+        assert 0 < min_interval <= max_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._heap = []
+        self._scheduled = {}
+
+    def __contains__(self, game_id):
+        return game_id in self._scheduled
+
+    def __len__(self):
+        return len(self._scheduled)
+
+    def schedule(self, game_id, when):
+        """Schedule a game to be polled at a given (unix) time."""
+        self._scheduled[game_id] = when
+        heapq.heappush(self._heap, (when, game_id))
+
+    def discard(self, game_id):
+        """Forget a game, so it is due immediately if it is still followed."""
+        # The heap entry is left behind and skipped once it is popped.
+        self._scheduled.pop(game_id, None)
+
+    def pop_due(self, now=None):
+        """Returns the IDs of all scheduled games which are due at `now`."""
+        now = time.time() if now is None else now
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, game_id = heapq.heappop(self._heap)
+            if self._scheduled.get(game_id) == when:
+                del self._scheduled[game_id]
+                due.append(game_id)
+        return due
+
+    def next_poll(self, game, alarm_hours=(), now=None):
+        """Returns the (unix) time at which a game should be polled next."""
+        now = time.time() if now is None else now
+        latest = now + self.max_interval
+        if game.won or game.drawn or not game.deadline:
+            return latest
+
+        deadline = game.deadline.timestamp()
+        if not game.pregame:
+            if deadline <= now < deadline + self.DEADLINE_WINDOW or \
+                    (game.ready and not game.not_ready):
+                return now + self.min_interval
+            targets = [deadline - hours*HOUR + self.GRACE
+                       for hours in alarm_hours]
+        else:
+            days = max(0, int((deadline - now) // DAY))
+            targets = [deadline - k*DAY - self.PREGAME_LEAD
+                       for k in (days, days - 1) if k >= 0]
+        targets.append(deadline + self.GRACE)
+
+        return min([t for t in targets if t > now] + [latest])
+
+    def reschedule(self, game, alarm_hours=(), now=None):
+        """Schedule the next poll of a game which has just been polled."""
+        self.schedule(game.game_id, self.next_poll(game, alarm_hours, now))
@@ -1,13 +1,92 @@
 """
 This module contains two sqlite3 tables; one for pollers with info on games and
 discord channels and one for notification alarms.
+
+Both tables share a single connection, which is only used from a dedicated
+database thread. The tables are mirrored in memory, so reads never touch the
+database; every write method has an awaitable `*_async` counterpart, which can
+be used from coroutines without blocking the event loop.
 """
 
+import asyncio
+import bisect
 import sqlite3
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+
 DEFAULT_DB_NAME = 'svetlana.db'
 
 
+def connect(dbfile):
+    """Opens a connection to the database in WAL mode.
+
+    With a write-ahead log, a commit only has to be synced to disk at
+    checkpoints, which makes `synchronous=NORMAL` safe against corruption.
+    """
+    connection = sqlite3.connect(dbfile)
+    connection.execute('PRAGMA journal_mode=WAL;')
+    connection.execute('PRAGMA synchronous=NORMAL;')
+    return connection
+
+
+class Database:
+    """A connection to a database file which is shared by all tables.
+
+    All statements are run on a single dedicated thread, so they are
+    serialized and the connection never crosses threads.
+    """
+    def __init__(self, dbfile=DEFAULT_DB_NAME):
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                thread_name_prefix='svetlana-db')
+        self.connection = self._executor.submit(connect, dbfile).result()
+
+    def _run(self, sql, params, many):
+        """Executes a statement in its own transaction and returns all rows."""
+        with self.connection:
+            if many:
+                cursor = self.connection.executemany(sql, params)
+            else:
+                cursor = self.connection.execute(sql, params)
+            return cursor.fetchall()
+
+    def execute(self, sql, params=(), many=False):
+        """Executes a statement and returns all resulting rows."""
+        return self._executor.submit(self._run, sql, params, many).result()
+
+    async def execute_async(self, sql, params=(), many=False):
+        """Executes a statement without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._run, sql,
+                params, many)
+
+    def close(self):
+        """Closes the connection and stops the database thread."""
+        self._executor.submit(self.connection.close).result()
+        self._executor.shutdown()
+
+
+def _database(database):
+    """Returns a `Database`, opening it if a filename is given."""
+    if isinstance(database, Database):
+        return database
+    return Database(database)
+
+
+def _create_table(database, table, columns, unique):
+    """Creates a table with a unique index on the given columns.
+
+    Duplicate rows, which could exist in databases from before the unique
+    index was introduced, are removed first (keeping the oldest).
+    """
+    database.execute(f'CREATE TABLE IF NOT EXISTS {table} ({columns});')
+    database.execute(f"""DELETE FROM {table} WHERE id NOT IN (
+        SELECT MIN(id) FROM {table} GROUP BY {unique});""")
+    database.execute(f"""CREATE UNIQUE INDEX IF NOT EXISTS {table}_unique
+        ON {table}({unique});""")
+
+
 class Pollers:
     """A simple list of Game ID-Discord channel pairs.
 
@@ -20,107 +99,250 @@ class Pollers:
     | channel    | Discord channel identifier                         |
     | last_delta | Number of seconds until deadline during last check |
 
+    The table is loaded into memory once and indexed by game and by channel;
+    writes go to both memory and the database.
+
+    Within a `batch` block, delta updates are kept in memory and written in a
+    single transaction at the end of the block (or on `flush`).
     """
-    def __init__(self, dbfile=DEFAULT_DB_NAME):
-        self.connection = sqlite3.connect(dbfile)
-        self.connection.execute("""CREATE TABLE IF NOT EXISTS pollers (
+    _INSERT = 'INSERT OR IGNORE INTO pollers(game,channel) VALUES(?,?);'
+    _DELETE = 'DELETE FROM pollers WHERE game = ? AND channel = ?;'
+    _UPDATE = 'UPDATE pollers SET last_delta=? WHERE game=? AND channel=?;'
+
+    def __init__(self, database=DEFAULT_DB_NAME):
+        self._pending = {}
+        self._batching = False
+        self._rows = {}
+        self._games = defaultdict(dict)
+        self._channels = defaultdict(dict)
+        self.database = _database(database)
+        _create_table(self.database, 'pollers', """
             id         INTEGER PRIMARY KEY,
             game       INTEGER NOT NULL,
             channel    INTEGER NOT NULL,
             last_delta INTEGER
-        );""")
-        self.connection.commit()
+        """, 'game, channel')
+        self.database.execute('DROP INDEX IF EXISTS pollers_game_channel;')
+
+        for game, channel, last_delta in self.database.execute(
+                'SELECT game, channel, last_delta FROM pollers ORDER BY id;'):
+            self._add((game, channel), last_delta)
 
     def __iter__(self):
-        pollers = self.connection.execute(
-                'SELECT game, channel, last_delta FROM pollers;')
-        for game, channel, last_delta in pollers:
+        for (game, channel), last_delta in list(self._rows.items()):
             yield (game, channel, last_delta)
 
     def __contains__(self, item):
         game, channel = item
-        cursor = self.connection.cursor()
-        cursor.execute(
-                'SELECT id FROM pollers WHERE game = ? AND channel = ?;',
-                (int(game), int(channel)))
-        data = cursor.fetchall()
-        return len(data) > 0
+        return (int(game), int(channel)) in self._rows
+
+    def __len__(self):
+        return len(self._rows)
 
     def __str__(self):
         return str(list(self))
 
-    def append(self, item):
-        """Append a game-channel pair to the list."""
+    def games(self):
+        """Returns the IDs of all followed games."""
+        return list(self._games)
+
+    def channels(self, game):
+        """Returns a dict which maps the channels following a game to their
+        last deltas."""
+        return {channel: self._rows[(game, channel)]
+                for channel in self._games.get(game, ())}
+
+    def channel_games(self, channel):
+        """Returns the IDs of the games followed in a channel."""
+        return list(self._channels.get(channel, ()))
+
+    def _add(self, key, last_delta=None):
+        """Adds a row to the in-memory mirror."""
+        game, channel = key
+        self._rows[key] = last_delta
+        self._games[game][channel] = None
+        self._channels[channel][game] = None
+
+    def _discard(self, key):
+        """Removes a row from the in-memory mirror."""
+        game, channel = key
+        self._pending.pop(key, None)
+        if self._rows.pop(key, False) is False:
+            return
+        for index, outer, inner in ((self._games, game, channel),
+                                    (self._channels, channel, game)):
+            del index[outer][inner]
+            if not index[outer]:
+                del index[outer]
+
+    @staticmethod
+    def _key(item):
         game, channel = item
         assert game > 0
         assert channel > 0
-        self.connection.execute(
-                'INSERT INTO pollers(game,channel) VALUES(?,?);',
-                (int(game), int(channel)))
-        self.connection.commit()
+        return (int(game), int(channel))
+
+    def append(self, item):
+        """Append a game-channel pair to the list."""
+        key = self._key(item)
+        self._add(key)
+        self.database.execute(self._INSERT, key)
+
+    async def append_async(self, item):
+        """Append a game-channel pair to the list."""
+        key = self._key(item)
+        self._add(key)
+        await self.database.execute_async(self._INSERT, key)
 
     def remove(self, item):
         """Remove a game-channel pair from the list."""
         game, channel = item
-        self.connection.execute(
-                'DELETE FROM pollers WHERE game = ? AND channel = ?;',
-                (int(game), int(channel)))
-        self.connection.commit()
+        key = (int(game), int(channel))
+        self._discard(key)
+        self.database.execute(self._DELETE, key)
+
+    async def remove_async(self, item):
+        """Remove a game-channel pair from the list."""
+        game, channel = item
+        key = (int(game), int(channel))
+        self._discard(key)
+        await self.database.execute_async(self._DELETE, key)
 
     def update_delta(self, item, delta):
         """Update the last delta of a given game-channel pair."""
         game, channel = item
         assert delta > 0
-        self.connection.execute(
-                'UPDATE pollers SET last_delta=? WHERE game=? AND channel=?;',
-                (int(delta), int(game), int(channel)))
-        self.connection.commit()
+        key = (int(game), int(channel))
+        if key not in self._rows:
+            return
+        self._rows[key] = self._pending[key] = int(delta)
+        if not self._batching:
+            self.flush()
+
+    def _take_pending(self):
+        """Returns the pending delta updates as parameters and clears them."""
+        pending, self._pending = self._pending, {}
+        return [(delta, game, channel)
+                for (game, channel), delta in pending.items()]
+
+    def flush(self):
+        """Write all pending delta updates in a single transaction."""
+        if self._pending:
+            self.database.execute(self._UPDATE, self._take_pending(),
+                    many=True)
+
+    async def flush_async(self):
+        """Write all pending delta updates in a single transaction."""
+        if self._pending:
+            await self.database.execute_async(self._UPDATE,
+                    self._take_pending(), many=True)
+
+    @contextmanager
+    def batch(self):
+        """Defer delta updates until the end of the block."""
+        self._batching = True
+        try:
+            yield self
+        finally:
+            self._batching = False
+            self.flush()
+
+    @asynccontextmanager
+    async def batch_async(self):
+        """Defer delta updates until the end of the block."""
+        self._batching = True
+        try:
+            yield self
+        finally:
+            self._batching = False
+            await self.flush_async()
 
 
 class Alarms:
-    """A simple list of alarms."""
-    def __init__(self, dbfile=DEFAULT_DB_NAME):
-        self.connection = sqlite3.connect(dbfile)
-        self.connection.execute("""CREATE TABLE IF NOT EXISTS alarms (
+    """A simple list of alarms.
+
+    The table is loaded into memory once, with a sorted list of alarm
+    thresholds per channel; writes go to both memory and the database.
+    """
+    _INSERT = 'INSERT OR IGNORE INTO alarms(hours, channel) VALUES(?,?);'
+    _DELETE = 'DELETE FROM alarms WHERE hours = ? AND channel = ?'
+
+    def __init__(self, database=DEFAULT_DB_NAME):
+        self._rows = {}
+        self._thresholds = defaultdict(list)
+        self.database = _database(database)
+        _create_table(self.database, 'alarms', """
             id      INTEGER PRIMARY KEY,
             hours   INTEGER NOT NULL,
             channel INTEGER NOT NULL
-        );""")
-        self.connection.commit()
+        """, 'hours, channel')
+        self.database.execute('DROP INDEX IF EXISTS alarms_channel_hours;')
+
+        for hours, channel in self.database.execute(
+                'SELECT hours, channel FROM alarms ORDER BY id;'):
+            self._add((int(hours), int(channel)))
 
     def __iter__(self):
-        alarms = self.connection.execute('SELECT hours, channel FROM alarms;')
-        for hours, channel in alarms:
-            yield (int(hours), int(channel))
+        yield from list(self._rows)
 
     def __contains__(self, item):
         alarm, channel = item
-        cursor = self.connection.cursor()
-        cursor.execute(
-                'SELECT id FROM alarms WHERE hours = ? AND channel = ?;',
-                (int(alarm), int(channel)))
-        data = cursor.fetchall()
-        return len(data) > 0
+        return (int(alarm), int(channel)) in self._rows
+
+    def __len__(self):
+        return len(self._rows)
 
     def __str__(self):
         return str(list(self))
 
-    def append(self, item):
-        """Append an alarm-channel pair to the list."""
+    def thresholds(self, channel):
+        """Returns the sorted alarm thresholds (in hours) of a channel."""
+        return self._thresholds.get(channel, [])
+
+    def _add(self, key):
+        """Adds a row to the in-memory mirror."""
+        if key in self._rows:
+            return
+        alarm, channel = key
+        self._rows[key] = None
+        bisect.insort(self._thresholds[channel], alarm)
+
+    def _discard(self, key):
+        """Removes a row from the in-memory mirror."""
+        if self._rows.pop(key, False) is False:
+            return
+        alarm, channel = key
+        self._thresholds[channel].remove(alarm)
+        if not self._thresholds[channel]:
+            del self._thresholds[channel]
+
+    @staticmethod
+    def _key(item):
         alarm, channel = item
         assert alarm > 0
         assert channel > 0
-        self.connection.execute(
-                'INSERT INTO alarms(hours, channel) VALUES(?,?);',
-                (int(alarm), int(channel)))
-        self.connection.commit()
+        return (int(alarm), int(channel))
+
+    def append(self, item):
+        """Append an alarm-channel pair to the list."""
+        key = self._key(item)
+        self._add(key)
+        self.database.execute(self._INSERT, key)
+
+    async def append_async(self, item):
+        """Append an alarm-channel pair to the list."""
+        key = self._key(item)
+        self._add(key)
+        await self.database.execute_async(self._INSERT, key)
 
     def remove(self, item):
         """Remove an alarm-channel pair from the list."""
-        alarm, channel = item
-        assert alarm > 0
-        assert channel > 0
-        self.connection.execute(
-                'DELETE FROM alarms WHERE hours = ? AND channel = ?',
-                (int(alarm), int(channel)))
-        self.connection.commit()
+        key = self._key(item)
+        self._discard(key)
+        self.database.execute(self._DELETE, key)
+
+    async def remove_async(self, item):
+        """Remove an alarm-channel pair from the list."""
+        key = self._key(item)
+        self._discard(key)
+        await self.database.execute_async(self._DELETE, key)
@@ -2,14 +2,56 @@
 This module contains an interface to the WebDiplomacy website.
 """
 
+import asyncio
+import hashlib
 import logging
+import random
+import threading
 import time
 import re
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from collections import defaultdict
+from urllib.parse import urlsplit
 
 import requests
+import requests.adapters
+
+
+# Every pattern is paired with a literal that any matching line must contain,
+# which allows skipping all other lines without a regex match.
+_PATTERNS = {
+    key: (anchor, re.compile(pattern)) for key, (anchor, pattern) in {
+        'name':      ('gameName">', r'.*gameName">(.*?)<.*'),
+        'date':      ('gameDate">', r'.*gameDate">(.*?)<.*'),
+        'phase':     ('gamePhase">', r'.*gamePhase">(.*?)<.*'),
+        'defeated':  ('memberStatusDefeated">',
+                      r'.*memberCountryName.*memberStatusDefeated">(.*?)<.*'),
+        'drawn':     ('memberStatusDrawn">',
+                      r'.*memberCountryName.*memberStatusDrawn">(.*?)<.*'),
+        'ready':     ('StatusPlaying">',
+                      r'.*memberCountryName.*tick.*rStatusPlaying">(.*?)<.*'),
+        'not_ready': ('StatusPlaying">',
+                      r'.*memberCountryName.*alert.*StatusPlaying">(.*?)<.*'),
+        'won':       ('memberStatusWon">',
+                      r'.*memberCountryName.*memberStatusWon">(.*?)<.*'),
+        'deadline':  ('gameTimeRemaining',
+                      r'.*gameTimeRemaining.*unixtime="([0-9]+)".*'),
+        'pregame':   ('memberPreGameList">', r'.*(memberPreGameList)">.*'),
+        'map_link':  ('LargeMapLink', r'.*<a.*LargeMapLink.*href="(.*?)".*'),
+    }.items()
+}
+_ANCHOR_SCANNER = re.compile('|'.join(
+    re.escape(anchor) for anchor in dict.fromkeys(
+        anchor for anchor, _ in _PATTERNS.values())))
+_DEADLINE_TOKENS = re.compile(r'gameTimeRemaining|unixtime="[0-9]+"')
+
+# Maps response validators to the request headers of a conditional request.
+VALIDATOR_HEADERS = {
+    'ETag': 'If-None-Match',
+    'Last-Modified': 'If-Modified-Since',
+}
 
 
 class InvalidGameError(Exception):
@@ -73,37 +115,170 @@ class DiplomacyGame:
         return self._timedelta.seconds if self.deadline else None
 
 
+class RateLimiter:
+    """Spaces out events to at most `rate` per second.
+
+    It can be used from threads (`wait`) as well as from coroutines
+    (`wait_async`); every call reserves the next free slot.
+    """
+    def __init__(self, rate):
+        self.interval = 1/rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Reserves a slot and returns the number of seconds until it."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+            return slot - now
+
+    def wait(self):
+        """Blocks until a slot is available."""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self):
+        """Waits until a slot is available without blocking the event loop."""
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
 class WebDiplomacyClient:
-    """Acts as an interface to the WebDiplomacy website."""
-    # pylint: disable=too-few-public-methods
-    # NOTE(jhartog): Although this class only has one public method, there are a
-    # number of reasons why it's better as a class; e.g. only having to specify
-    # the url once without sketchy global variables.
-    def __init__(self, url='https://webdiplomacy.net/'):
+    """Acts as an interface to the WebDiplomacy website.
+
+    Besides the blocking `fetch`, games can be fetched from a coroutine with
+    `fetch_async`. Those requests are run on a thread pool so the event loop
+    never blocks on network I/O; `max_requests` caps the number of requests
+    which are in flight at the same time.
+
+    Every host gets a persistent session which keeps up to `max_requests`
+    connections alive, and at most `max_rate` requests per second are sent to
+    a host (unlimited if it is None).
+    """
+    # pylint: disable=too-many-instance-attributes
+    # Seconds to wait before the first retry; it doubles for every retry,
+    # until it exceeds RETRY_LIMIT and the request fails.
+    RETRY_BASE = 1
+    RETRY_LIMIT = 300
+    # Seconds to wait for a connection and for a response, respectively.
+    TIMEOUT = (10, 30)
+
+    def __init__(self, url='https://webdiplomacy.net/', max_requests=8,
+            max_rate=5):
+        assert max_requests > 0
         self.url = url
+        self.max_requests = max_requests
+        self.max_rate = max_rate
+        self._executor = ThreadPoolExecutor(max_workers=max_requests,
+                thread_name_prefix='webdiplomacy')
+        self._semaphore = None
+        self._validators = {}
+        self._games = {}
+        self._hosts = {}
+        self._hosts_lock = threading.Lock()
 
-    def _request(self, url, timeout=1, threshold=300):
-        """Performs a HTTPS request and returns the response body.
+    def _host(self, url):
+        """Returns the session and rate limiter of the host of a url."""
+        host = urlsplit(url).netloc
+        with self._hosts_lock:
+            if host not in self._hosts:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                        pool_maxsize=self.max_requests, pool_block=True)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._hosts[host] = (session, RateLimiter(self.max_rate))
+            return self._hosts[host]
 
-        When it fails, it tries again after an increasing timeout until the
-        timeout reaches a given threshold.
+    def _backoff(self):
+        """Yields the (jittered) delays between retries.
+
+        Every delay is drawn from the upper half of an exponentially growing
+        range, so clients which failed at the same time do not retry in sync.
         """
-        try:
-            # pylint: disable=bare-except
-            # NOTE(jhartog): A bare except is justified here as it's retrying
-            # the request a finite amount of times. If there is a bug, it will
-            # be raised.
-            response = requests.get(url)
-            response.raise_for_status()
-            return response.text
-        except:
-            if timeout > threshold:
-                raise
-            time.sleep(timeout)
-            self._request(url, timeout=timeout*2)
+        delay = self.RETRY_BASE
+        while delay <= self.RETRY_LIMIT:
+            yield delay/2 + random.uniform(0, delay/2)
+            delay *= 2
+
+    def _request_once(self, url, headers=None):
+        """Performs a single HTTPS request and returns the response body.
+
+        The validators (ETag/Last-Modified) of the response are stored, so they
+        can be passed as `headers` in a next conditional request. When the
+        server reports that the page was not modified, None is returned.
+        """
+        session, _ = self._host(url)
+        response = session.get(url, headers=headers, timeout=self.TIMEOUT)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        self._validators[url] = {
+                header: response.headers[name]
+                for name, header in VALIDATOR_HEADERS.items()
+                if name in response.headers}
+        return response.text
+
+    def _request(self, url, headers=None):
+        """Performs a HTTPS request and returns the response body (see
+        `_request_once`).
+
+        When it fails, it tries again after an increasing, jittered delay
+        until the delay reaches a given threshold.
+        """
+        _, limiter = self._host(url)
+        for delay in self._backoff():
+            limiter.wait()
+            try:
+                return self._request_once(url, headers)
+            except requests.RequestException as exc:
+                logging.warning('Request to %s failed, retrying in %.1fs: %r',
+                        url, delay, exc)
+            time.sleep(delay)
+        limiter.wait()
+        return self._request_once(url, headers)
+
+    async def _request_async(self, url, headers=None):
+        """Performs a HTTPS request like `_request`, but runs it on the thread
+        pool and waits between retries without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        _, limiter = self._host(url)
+        for delay in self._backoff():
+            await limiter.wait_async()
+            try:
+                return await loop.run_in_executor(self._executor,
+                        self._request_once, url, headers)
+            except requests.RequestException as exc:
+                logging.warning('Request to %s failed, retrying in %.1fs: %r',
+                        url, delay, exc)
+            await asyncio.sleep(delay)
+        await limiter.wait_async()
+        return await loop.run_in_executor(self._executor, self._request_once,
+                url, headers)
 
     @staticmethod
-    def _parse(content):
+    def _anchored_lines(content):
+        """Yields the (stripped) lines of a page which contain an anchor.
+
+        Most lines of a game page (chat, order history) are irrelevant. A
+        single scan for the anchors finds the few lines which might match.
+        """
+        end = -1
+        for hit in _ANCHOR_SCANNER.finditer(content):
+            if hit.start() < end:
+                continue
+            start = content.rfind('\n', 0, hit.start()) + 1
+            end = content.find('\n', hit.end())
+            if end < 0:
+                end = len(content)
+            yield content[start:end].strip()
+
+    @classmethod
+    def _parse(cls, content):
         """Parses the contents of a WebDiplomacy game page.
 
         Returns a dict with country and game info.
@@ -111,40 +286,121 @@ class WebDiplomacyClient:
         Note that exceptions are not caught by design, these should be handled
         outside of this function.
         """
-        patterns = {
-            'name':      r'.*gameName">(.*?)<.*',
-            'date':      r'.*gameDate">(.*?)<.*',
-            'phase':     r'.*gamePhase">(.*?)<.*',
-            'defeated':  r'.*memberCountryName.*memberStatusDefeated">(.*?)<.*',
-            'drawn':     r'.*memberCountryName.*memberStatusDrawn">(.*?)<.*',
-            'ready':     r'.*memberCountryName.*tick.*rStatusPlaying">(.*?)<.*',
-            'not_ready': r'.*memberCountryName.*alert.*StatusPlaying">(.*?)<.*',
-            'won':       r'.*memberCountryName.*memberStatusWon">(.*?)<.*',
-            'deadline':  r'.*gameTimeRemaining.*unixtime="([0-9]+)".*',
-            'pregame':   r'.*(memberPreGameList)">.*',
-            'map_link':  r'.*<a.*LargeMapLink.*href="(.*?)".*',
-        }
+        return cls._parse_lines(cls._anchored_lines(content))
+
+    @staticmethod
+    def _parse_lines(lines):
+        """Parses the anchored lines of a WebDiplomacy game page."""
         data = defaultdict(list)
 
-        for line in content.split('\n'):
-            for key, pattern in patterns.items():
-                match = re.match(pattern, line.strip())
-                if match:
-                    data[key] += [match.group(1)]
+        for line in lines:
+            for key, (anchor, pattern) in _PATTERNS.items():
+                if anchor in line:
+                    match = pattern.match(line)
+                    if match:
+                        data[key].append(match.group(1))
 
         logging.debug('Parsed data: %s', data)
 
         return data
 
-    def fetch(self, game_id, endpoint='board.php?gameID={}'):
-        """Fetches info from WebDiplomacy, parses it and returns the data."""
+    @staticmethod
+    def _fingerprint(lines):
+        """Returns a digest of the anchored lines which `_parse` depends on.
+
+        Two pages with the same fingerprint are parsed to the same data. Lines
+        which only hold the deadline are reduced to their timestamps, so the
+        countdown text does not change the fingerprint.
+        """
+        digest = hashlib.sha1()
+        for line in lines:
+            anchors = [a for a, _ in _PATTERNS.values() if a in line]
+            if anchors == [_PATTERNS['deadline'][0]]:
+                line = ' '.join(_DEADLINE_TOKENS.findall(line))
+            digest.update(line.encode())
+            digest.update(b'\n')
+        return digest.hexdigest()
+
+    def _conditional_headers(self, url):
+        """Returns the headers for a conditional request of a cached page."""
+        return self._validators.get(url) if url in self._games else None
+
+    def _process(self, game_id, endpoint, response):
+        """Parses a game page and returns the game.
+
+        The last game is cached per page and returned as-is when the server
+        reported the page is not modified (`response` is None), or when its
+        fingerprint did not change.
+        """
+        url = self.url + endpoint.format(game_id)
+        cached = self._games.get(url)
         try:
-            response = self._request(self.url + endpoint.format(game_id))
-            data = self._parse(response)
+            if response is None and cached:
+                return cached[1]
+
+            lines = list(self._anchored_lines(response))
+            fingerprint = self._fingerprint(lines)
+            if cached and cached[0] == fingerprint:
+                return cached[1]
+
+            data = self._parse_lines(lines)
             game = DiplomacyGame(game_id, data, self.url,
                     endpoint.format(game_id))
+            self._games[url] = (fingerprint, game)
             return game
         except (IndexError, KeyError) as exc:
             # NOTE(jhartog): This is a parsing error, which most probably means
             # the game ID is invalid or the game has been cancelled.
+            self._games.pop(url, None)
             raise InvalidGameError from exc
+
+    def fetch(self, game_id, endpoint='board.php?gameID={}'):
+        """Fetches info from WebDiplomacy, parses it and returns the data."""
+        url = self.url + endpoint.format(game_id)
+        response = self._request(url, self._conditional_headers(url))
+        return self._process(game_id, endpoint, response)
+
+    async def fetch_async(self, game_id, endpoint='board.php?gameID={}'):
+        """Fetches a game without blocking the event loop.
+
+        At most `max_requests` fetches are in flight at the same time, others
+        wait for a free slot.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_requests)
+
+        url = self.url + endpoint.format(game_id)
+        async with self._semaphore:
+            response = await self._request_async(url,
+                    self._conditional_headers(url))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._process,
+                game_id, endpoint, response)
+
+    def _map_digest(self, map_url):
+        """Downloads a map and returns its digest, or None if it is not an
+        image (yet)."""
+        session, limiter = self._host(map_url)
+        limiter.wait()
+        response = session.get(map_url, timeout=self.TIMEOUT)
+        if response.status_code != 200 or not \
+                response.headers.get('Content-Type', '').startswith('image/'):
+            return None
+        return hashlib.sha1(response.content).hexdigest()
+
+    async def fetch_map_digest(self, map_url):
+        """Downloads a map without blocking the event loop and returns its
+        digest, or None if it is not an image (yet)."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._map_digest,
+                map_url)
+
+    async def fetch_all(self, game_ids):
+        """Fetches a number of games concurrently.
+
+        Returns a list with, for each given game ID, either a `DiplomacyGame`
+        or the exception that was raised while fetching it.
+        """
+        return await asyncio.gather(
+                *(self.fetch_async(game_id) for game_id in game_ids),
+                return_exceptions=True)
@@ -6,6 +6,7 @@ from datetime import datetime
 
 from svetlana.bot.actions import DESCRIPTION
 from svetlana.bot.client import DiscordClient
+from svetlana.bot.delivery import MapDeliveryQueue
 from svetlana.webdiplomacy import DiplomacyGame
 
 MINUTE = 60
@@ -36,6 +37,9 @@ class MockWebDiplomacyClient:
     def fetch(self, _):
         return self._response
 
+    async def fetch_all(self, game_ids):
+        return [self._response for _ in game_ids]
+
 
 @pytest.mark.asyncio
 async def test_help(mocker, monkeypatch):
@@ -155,7 +159,7 @@ async def test_poll_pregame(mocker, monkeypatch):
 
         client = DiscordClient(None, ':memory:', False)
 
-        msg = client._poll(game, 1, None, 0)
+        msg = client._poll(game, 1, None)
         assert msg == f'The game starts in {N} days!'
 
     for N in range(7):
@@ -180,7 +184,7 @@ async def test_poll_two_hours_left_ready(mocker, monkeypatch):
     client = DiscordClient(None, ':memory:', False)
     await client.on_message(MockMessage('svetlana alert 2'))
 
-    msg = client._poll(game, 1, 3*HOUR, 0)
+    msg = client._poll(game, 1, 3*HOUR)
     assert msg == "2h left, everybody's ready!"
 
 @pytest.mark.asyncio
@@ -202,7 +206,7 @@ async def test_poll_two_hours_left_not_ready(mocker, monkeypatch):
     client = DiscordClient(None, ':memory:', False)
     await client.on_message(MockMessage('svetlana alert 2'))
 
-    msg = client._poll(game, 1, 3*HOUR, 0)
+    msg = client._poll(game, 1, 3*HOUR)
     assert msg == "2h left! These countries aren't ready: Turkey, France"
 
 @pytest.mark.asyncio
@@ -223,7 +227,7 @@ async def test_poll_drawn(mocker, monkeypatch):
 
     client = DiscordClient(None, ':memory:', False)
 
-    msg = client._poll(game, 1, None, 0)
+    msg = client._poll(game, 1, None)
     assert msg == 'The game was a draw between France, Russia!'
 
 @pytest.mark.asyncio
@@ -244,7 +248,7 @@ async def test_poll_won(mocker, monkeypatch):
 
     client = DiscordClient(None, ':memory:', False)
 
-    msg = client._poll(game, 1, None, 0)
+    msg = client._poll(game, 1, None)
     assert msg == 'Russia has won!'
 
 @pytest.mark.asyncio
@@ -265,5 +269,190 @@ async def test_poll_new_round(mocker, monkeypatch):
 
     client = DiscordClient(None, ':memory:', False)
 
-    msg = client._poll(game, 1, 10, 0)
+    msg = client._poll(game, 1, 10)
     assert msg == 'Starting new round! Good luck :)'
+
+@pytest.mark.asyncio
+async def test_poll_cycle(mocker, monkeypatch):
+    wd_client = MockWebDiplomacyClient({
+        'name': ['Mock'],
+        'date': ['Spring, 1901'],
+        'phase': ['Diplomacy'],
+        'deadline': [str(int(datetime.now().timestamp())+HOUR)],
+        'defeated': [],
+        'not_ready': [],
+        'ready': [],
+        'won': ['Russia'],
+        'drawn': [],
+        'pregame': [],
+        'map_link': ['foo.jpg'],
+    })
+    client = DiscordClient(wd_client, ':memory:', False)
+    channel = MockChannel()
+    send_spy = mocker.spy(channel, 'send')
+    monkeypatch.setattr(client, 'get_channel', lambda _: channel)
+
+    await client.follow(1, 1)
+    await client._poll_cycle()
+
+    args, kwargs = send_spy.call_args
+    assert kwargs['embed'].description == 'Russia has won!'
+    assert list(client.pollers) == []
+
+@pytest.mark.asyncio
+async def test_poll_cycle_fan_out(mocker, monkeypatch):
+    wd_client = MockWebDiplomacyClient({
+        'name': ['Mock'],
+        'date': ['Spring, 1901'],
+        'phase': ['Diplomacy'],
+        'deadline': [str(int(datetime.now().timestamp())+HOUR)],
+        'defeated': [],
+        'not_ready': [],
+        'ready': [],
+        'won': [],
+        'drawn': ['France', 'Russia'],
+        'pregame': [],
+        'map_link': ['foo.jpg'],
+    })
+    fetch_spy = mocker.spy(wd_client, 'fetch_all')
+    client = DiscordClient(wd_client, ':memory:', False)
+    channels = {1: MockChannel(), 2: MockChannel()}
+    send_spies = {i: mocker.spy(c, 'send') for i, c in channels.items()}
+    monkeypatch.setattr(client, 'get_channel', lambda i: channels[i])
+
+    await client.follow(1, 1)
+    await client.follow(1, 2)
+    await client._poll_cycle()
+
+    args, kwargs = fetch_spy.call_args
+    assert args[0] == [1]
+    for send_spy in send_spies.values():
+        args, kwargs = send_spy.call_args
+        assert kwargs['embed'].description == \
+                'The game was a draw between France, Russia!'
+    assert list(client.pollers) == []
+
+@pytest.mark.asyncio
+async def test_poll_cycle_schedule(mocker, monkeypatch):
+    wd_client = MockWebDiplomacyClient({
+        'name': ['Mock'],
+        'date': ['Spring, 1901'],
+        'phase': ['Diplomacy'],
+        'deadline': [str(int(datetime.now().timestamp())+DAY)],
+        'defeated': [],
+        'not_ready': ['France'],
+        'ready': [],
+        'won': [],
+        'drawn': [],
+        'pregame': [],
+        'map_link': ['foo.jpg'],
+    })
+    fetch_spy = mocker.spy(wd_client, 'fetch_all')
+    client = DiscordClient(wd_client, ':memory:', False)
+
+    await client.follow(1, 1)
+    await client._poll_cycle()
+    await client._poll_cycle()
+    assert fetch_spy.call_args_list[0][0][0] == [1]
+    assert fetch_spy.call_args_list[1][0][0] == []
+
+    await client.add_alert(2, 1)
+    await client._poll_cycle()
+    assert fetch_spy.call_args_list[2][0][0] == [1]
+
+@pytest.mark.asyncio
+async def test_poll_alarm_index(mocker, monkeypatch):
+    game = DiplomacyGame(1, {
+        'name': ['Mock'],
+        'date': ['Spring, 1901'],
+        'phase': ['Diplomacy'],
+        'deadline': [str(int(datetime.now().timestamp())+HOUR)],
+        'defeated': [],
+        'not_ready': ['Turkey'],
+        'ready': [],
+        'won': [],
+        'drawn': [],
+        'pregame': [],
+        'map_link': ['foo.jpg'],
+    }, '', '')
+
+    client = DiscordClient(None, ':memory:', False)
+    await client.add_alert(6, 1)
+    await client.add_alert(2, 1)
+    await client.add_alert(12, 2)
+    await client.add_alert(3, 2)
+    await client.remove_alert(3, 2)
+
+    alarm_messages = {}
+    msg = client._poll(game, 1, 8*HOUR, alarm_messages)
+    assert msg == "2h left! These countries aren't ready: Turkey"
+    assert alarm_messages == {2: msg}
+    assert client._poll(game, 2, 8*HOUR, alarm_messages) is None
+    assert client._poll(game, 1, HOUR + MINUTE, alarm_messages) is None
+
+@pytest.mark.asyncio
+async def test_map_delivery(mocker, monkeypatch):
+    class MockMapClient:
+        digests = [None, 'old', 'old', 'old', 'new']
+
+        async def fetch_map_digest(self, _):
+            return self.digests.pop(0)
+
+    game = DiplomacyGame(1, {
+        'name': ['Mock'],
+        'date': ['Spring, 1901'],
+        'phase': ['Diplomacy'],
+        'deadline': [str(int(datetime.now().timestamp())+DAY)],
+        'defeated': [],
+        'not_ready': [],
+        'ready': [],
+        'won': [],
+        'drawn': [],
+        'pregame': [],
+        'map_link': ['foo.jpg'],
+    }, '', '')
+    sent = []
+
+    async def send(channel_id, **kwargs):
+        sent.append((channel_id, kwargs))
+
+    queue = MapDeliveryQueue(MockMapClient(), send, interval=0)
+    await queue.defer(game, [(1, {'content': 'a'}), (2, {'content': 'a'})])
+    assert sent == [(1, {'content': 'a'}), (2, {'content': 'a'})]
+
+    await queue.defer(game, [(1, {'content': 'b'})])
+    assert sent[-1] == (1, {'content': 'b'})
+    assert MockMapClient.digests == []
+    assert len(queue) == 0
+
+@pytest.mark.asyncio
+async def test_poll_cycle_new_round_deferred(mocker, monkeypatch):
+    wd_client = MockWebDiplomacyClient({
+        'name': ['Mock'],
+        'date': ['Spring, 1901'],
+        'phase': ['Diplomacy'],
+        'deadline': [str(int(datetime.now().timestamp())+DAY)],
+        'defeated': [],
+        'not_ready': [],
+        'ready': [],
+        'won': [],
+        'drawn': [],
+        'pregame': [],
+        'map_link': ['foo.jpg'],
+    })
+    client = DiscordClient(wd_client, ':memory:', False)
+    channel = MockChannel()
+    send_spy = mocker.spy(channel, 'send')
+    monkeypatch.setattr(client, 'get_channel', lambda _: channel)
+    defer_spy = mocker.patch.object(client.map_delivery, 'defer')
+
+    await client.follow(1, 1)
+    client.pollers.update_delta((1, 1), 10)
+    await client._poll_cycle()
+
+    assert send_spy.call_count == 0
+    args, kwargs = defer_spy.call_args
+    assert args[0] is wd_client._response
+    (channel_id, message), = args[1]
+    assert channel_id == 1
+    assert message['embed'].description == 'Starting new round! Good luck :)'
@@ -1,6 +1,6 @@
 import pytest
 
-from svetlana.db import Pollers, Alarms
+from svetlana.db import Database, Pollers, Alarms
 
 
 def test_pollers_iter_append(mocker, monkeypatch):
@@ -62,3 +62,71 @@ def test_alarms_str(mocker, monkeypatch):
         alarms.append((x, y))
 
     assert str(alarms) == '[(1, 2), (3, 4)]'
+
+def test_pollers_batch(mocker, monkeypatch):
+    pollers = Pollers(':memory:')
+    pollers.append((1, 2))
+    pollers.append((3, 4))
+    flush_spy = mocker.spy(pollers, 'flush')
+
+    with pollers.batch():
+        pollers.update_delta((1, 2), 100)
+        pollers.update_delta((3, 4), 200)
+        pollers.update_delta((1, 2), 50)
+        assert list(pollers) == [(1, 2, 50), (3, 4, 200)]
+        assert Pollers(pollers.database).channels(1) == {2: None}
+
+    assert flush_spy.call_count == 1
+    assert Pollers(pollers.database).channels(1) == {2: 50}
+
+    pollers.update_delta((3, 4), 150)
+    assert list(pollers) == [(1, 2, 50), (3, 4, 150)]
+
+def test_pollers_wal(mocker, monkeypatch, tmp_path):
+    pollers = Pollers(str(tmp_path / 'svetlana.db'))
+    (mode,), = pollers.database.execute('PRAGMA journal_mode;')
+    assert mode == 'wal'
+
+@pytest.mark.asyncio
+async def test_shared_database_async(mocker, monkeypatch):
+    database = Database(':memory:')
+    pollers = Pollers(database)
+    alarms = Alarms(database)
+
+    await pollers.append_async((1, 2))
+    await pollers.append_async((1, 3))
+    await alarms.append_async((3, 2))
+    await alarms.append_async((1, 2))
+
+    async with pollers.batch_async():
+        pollers.update_delta((1, 2), 100)
+
+    # A fresh mirror is loaded from the (shared) database.
+    pollers = Pollers(database)
+    alarms = Alarms(database)
+    assert list(pollers) == [(1, 2, 100), (1, 3, None)]
+    assert pollers.games() == [1]
+    assert pollers.channels(1) == {2: 100, 3: None}
+    assert pollers.channel_games(3) == [1]
+    assert alarms.thresholds(2) == [1, 3]
+
+    await pollers.remove_async((1, 2))
+    await alarms.remove_async((3, 2))
+    assert pollers.channel_games(2) == []
+    assert alarms.thresholds(2) == [1]
+    assert list(Pollers(database)) == [(1, 3, None)]
+    assert list(Alarms(database)) == [(1, 2)]
+
+def test_unique(mocker, monkeypatch):
+    database = Database(':memory:')
+    database.execute("""CREATE TABLE pollers (id INTEGER PRIMARY KEY,
+        game INTEGER NOT NULL, channel INTEGER NOT NULL, last_delta INTEGER
+    );""")
+    database.execute('INSERT INTO pollers(game, channel) VALUES (1, 2);')
+    database.execute('INSERT INTO pollers(game, channel) VALUES (1, 2);')
+
+    pollers = Pollers(database)
+    pollers.append((1, 2))
+
+    assert database.execute('SELECT game, channel FROM pollers;') == [(1, 2)]
+    assert list(pollers) == [(1, 2, None)]
@@ -0,0 +1,87 @@
+import pytest
+
+from datetime import datetime
+
+from svetlana.bot.scheduler import PollScheduler
+from svetlana.webdiplomacy import DiplomacyGame
+
+MINUTE = 60
+HOUR = 60*MINUTE
+DAY = 24*HOUR
+NOW = 1600000000
+
+
+def mock_game(deadline, pregame=False, ready=(), not_ready=('France',)):
+    return DiplomacyGame(1, {
+        'name': ['Mock'],
+        'date': ['Spring, 1901'],
+        'phase': ['Diplomacy'],
+        'deadline': [str(deadline)],
+        'defeated': [],
+        'not_ready': list(not_ready),
+        'ready': list(ready),
+        'won': [],
+        'drawn': [],
+        'pregame': ['foo'] if pregame else [],
+        'map_link': ['foo.jpg'],
+    }, '', '')
+
+def test_pop_due(mocker, monkeypatch):
+    scheduler = PollScheduler()
+    scheduler.schedule(1, NOW + 20)
+    scheduler.schedule(2, NOW + 10)
+    scheduler.schedule(3, NOW + 30)
+    scheduler.discard(3)
+
+    assert 1 in scheduler
+    assert 3 not in scheduler
+    assert scheduler.pop_due(NOW) == []
+    assert scheduler.pop_due(NOW + 40) == [2, 1]
+    assert len(scheduler) == 0
+
+def test_reschedule_overrides(mocker, monkeypatch):
+    scheduler = PollScheduler()
+    scheduler.schedule(1, NOW + 10)
+    scheduler.schedule(1, NOW + 100)
+
+    assert scheduler.pop_due(NOW + 50) == []
+    assert scheduler.pop_due(NOW + 100) == [1]
+
+def test_next_poll_sparse(mocker, monkeypatch):
+    scheduler = PollScheduler(max_interval=5*MINUTE)
+    game = mock_game(NOW + 3*DAY)
+
+    assert scheduler.next_poll(game, {2}, NOW) == NOW + 5*MINUTE
+
+def test_next_poll_alarm(mocker, monkeypatch):
+    scheduler = PollScheduler(max_interval=5*MINUTE)
+    game = mock_game(NOW + 2*HOUR + MINUTE)
+
+    assert scheduler.next_poll(game, {2}, NOW) == \
+            NOW + MINUTE + PollScheduler.GRACE
+    assert scheduler.next_poll(game, {1, 2}, NOW + 2*MINUTE) == \
+            NOW + 7*MINUTE
+
+def test_next_poll_deadline(mocker, monkeypatch):
+    scheduler = PollScheduler(min_interval=30)
+    game = mock_game(NOW + MINUTE)
+
+    assert scheduler.next_poll(game, (), NOW) == \
+            NOW + MINUTE + PollScheduler.GRACE
+    assert scheduler.next_poll(game, (), NOW + 2*MINUTE) == \
+            NOW + 2*MINUTE + 30
+
+def test_next_poll_everybody_ready(mocker, monkeypatch):
+    scheduler = PollScheduler(min_interval=30)
+    game = mock_game(NOW + DAY, ready=['France'], not_ready=[])
+
+    assert scheduler.next_poll(game, (), NOW) == NOW + 30
+
+def test_next_poll_pregame(mocker, monkeypatch):
+    scheduler = PollScheduler(max_interval=DAY)
+    game = mock_game(NOW + 3*DAY + HOUR, pregame=True)
+
+    when = scheduler.next_poll(game, (), NOW)
+    assert when == NOW + HOUR - PollScheduler.PREGAME_LEAD
+    when = scheduler.next_poll(game, (), when)
+    assert when == NOW + DAY + HOUR - PollScheduler.PREGAME_LEAD
@@ -1,12 +1,18 @@
 import pytest
 from datetime import datetime
+import glob
+import os
+import threading
 import time
 
+from benchmarks.parse import legacy_parse
 from svetlana.webdiplomacy import DiplomacyGame, WebDiplomacyClient, \
                                   InvalidGameError
 
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
 
-def test_client_won(mocker, monkeypatch):
+
+def test_client_won(monkeypatch, mocker):
     response = """<foo gameTimeRemaining unixtime="1337">
     <foo memberCountryName><bar memberStatusWon">Russia</bar>
     <a LargeMapLink href="foo.jpg">
@@ -31,7 +37,7 @@ def test_client_won(mocker, monkeypatch):
     assert game.phase == 'Diplomacy'
     assert game.date == 'Spring 1901'
 
-def test_client_draw(mocker, monkeypatch):
+def test_client_draw(monkeypatch, mocker):
     response = """<foo gameTimeRemaining unixtime="1337">
     <foo memberCountryName><bar memberStatusDrawn">Russia</bar>
     <foo memberCountryName><bar memberStatusDrawn">France</bar>
@@ -54,7 +60,7 @@ def test_client_draw(mocker, monkeypatch):
     assert not game.pregame
     assert game.map_url == 'https://webdiplomacy.net/foo.jpg&time=12345'
 
-def test_client_pregame(mocker, monkeypatch):
+def test_client_pregame(monkeypatch, mocker):
     response = """<foo gameTimeRemaining unixtime="1337">
     <foo "memberPreGameList">
     <a LargeMapLink href="foo.jpg">
@@ -74,7 +80,7 @@ def test_client_pregame(mocker, monkeypatch):
     assert game.pregame
     assert game.map_url == 'https://webdiplomacy.net/foo.jpg&time=12345'
 
-def test_client_ready(mocker, monkeypatch):
+def test_client_ready(monkeypatch, mocker):
     response = """<foo gameTimeRemaining unixtime="1337">
     <foo memberCountryName>tick<bar "MemberStatusPlaying">Italy</bar>
     <foo memberCountryName>tick<bar "MemberStatusPlaying">France</bar>
@@ -97,7 +103,7 @@ def test_client_ready(mocker, monkeypatch):
     assert 'France' in game.ready
     assert game.map_url == 'https://webdiplomacy.net/foo.jpg&time=12345'
 
-def test_client_not_ready(mocker, monkeypatch):
+def test_client_not_ready(monkeypatch, mocker):
     response = """<foo gameTimeRemaining unixtime="1337">
     <foo memberCountryName>alert<bar "MemberStatusPlaying">Italy</bar>
     <foo memberCountryName>alert<bar "MemberStatusPlaying">France</bar>
@@ -211,3 +217,96 @@ def test_game_negative_id(mocker, monkeypatch):
             'pregame': ['foo'],
             'map_link': [''],
         }, '', '')
+
+@pytest.mark.asyncio
+async def test_client_fetch_all_concurrency(mocker, monkeypatch):
+    in_flight = []
+    peak = []
+    lock = threading.Lock()
+
+    def fetch(self, game_id):
+        with lock:
+            in_flight.append(game_id)
+            peak.append(len(in_flight))
+        time.sleep(0.05)
+        with lock:
+            in_flight.remove(game_id)
+        if game_id == 3:
+            raise InvalidGameError
+        return game_id
+
+    monkeypatch.setattr(WebDiplomacyClient, 'fetch', fetch)
+
+    client = WebDiplomacyClient(max_requests=2)
+    games = await client.fetch_all([1, 2, 3, 4, 5])
+
+    assert games[:2] == [1, 2]
+    assert isinstance(games[2], InvalidGameError)
+    assert games[3:] == [4, 5]
+    assert max(peak) == 2
+
+def test_parse_fixture(mocker, monkeypatch):
+    with open(os.path.join(FIXTURES, 'board_playing.html')) as page:
+        data = WebDiplomacyClient._parse(page.read())
+
+    assert data['name'] == ['Mock Game']
+    assert data['date'] == ['Autumn, 1903']
+    assert data['phase'] == ['Diplomacy']
+    assert data['deadline'] == ['1607781600']
+    assert data['ready'] == ['England', 'Germany', 'Turkey', 'Russia']
+    assert data['not_ready'] == ['France', 'Austria']
+    assert data['defeated'] == ['Italy']
+    assert data['map_link'] == ['map.php?gameID=1234&largemap=on&turn=5']
+    assert not data['pregame']
+
+def test_parse_legacy_equivalence(mocker, monkeypatch):
+    for path in glob.glob(os.path.join(FIXTURES, 'board_*.html')):
+        with open(path) as page:
+            content = page.read()
+        assert WebDiplomacyClient._parse(content) == legacy_parse(content)
+
+class MockResponse:
+    def __init__(self, text, status_code=200, headers=None):
+        self.text = text
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        pass
+
+def test_client_not_modified(mocker, monkeypatch):
+    with open(os.path.join(FIXTURES, 'board_playing.html')) as page:
+        content = page.read()
+    responses = [
+        MockResponse(content, headers={'ETag': '"abc"'}),
+        MockResponse('', status_code=304),
+    ]
+    get = mocker.patch('requests.get', side_effect=responses)
+    parse_spy = mocker.spy(WebDiplomacyClient, '_parse_lines')
+
+    client = WebDiplomacyClient()
+    game = client.fetch(1234)
+
+    assert client.fetch(1234) is game
+    assert parse_spy.call_count == 1
+    args, kwargs = get.call_args
+    assert kwargs['headers'] == {'If-None-Match': '"abc"'}
+
+def test_client_fingerprint(mocker, monkeypatch):
+    with open(os.path.join(FIXTURES, 'board_playing.html')) as page:
+        content = page.read()
+    countdown = content.replace('<strong>2 days</strong>',
+            '<strong>1 day</strong>')
+    chat = content.replace('</table></div>',
+            '<tr><td>France: hello</td></tr></table></div>')
+    not_ready = content.replace('tick.png', 'alert.png', 1)
+    responses = [MockResponse(c) for c in (content, countdown, chat, not_ready)]
+    mocker.patch('requests.get', side_effect=responses)
+
+    client = WebDiplomacyClient()
+    game = client.fetch(1234)
+
+    assert client.fetch(1234) is game
+    assert client.fetch(1234) is game
+    game = client.fetch(1234)
+    assert 'England' in game.not_ready